@@ -1,9 +1,13 @@
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import time
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import argparse
 import sys
+import signal
 
 # Configure logging to stdout only
 logging.basicConfig(
@@ -14,58 +18,134 @@ logging.basicConfig(
 logger = logging.getLogger("flashbots_validator_tracker")
 
 class FlashbotsValidatorTracker:
+    __slots__ = (
+        "source_relay",
+        "target_urls",
+        "interval",
+        "incremental_post",
+        "digests",
+        "transformed_by_pubkey",
+        "last_etag",
+        "last_modified",
+        "last_content_length",
+        "head_probe",
+        "stopping",
+        "session",
+        "probe_session"
+    )
+    
     def __init__(self, config):
         self.source_relay = config["source_relay"]
         # Ensure source relay URL has the correct path
         if not self.source_relay.endswith("/relay/v1/builder/validators"):
             self.source_relay = self.source_relay.rstrip("/") + "/relay/v1/builder/validators"
             
-        self.target_relay = config["target_relay"]
+        # Build the full POST URL for each target once instead of on every post
+        self.target_urls = tuple(
+            target_relay.rstrip("/") + "/eth/v1/builder/validators"
+            for target_relay in config["target_relays"]
+        )
         self.interval = config["interval"]
-        self.validators = None  # Store validators in memory
+        self.incremental_post = config.get("incremental_post", False)  # Post only changed registrations after the first run
+        self.digests = {}  # Store a pubkey -> entry hash map instead of the full validator list
+        self.transformed_by_pubkey = None  # Cached POST payload, patched with each change set
+        # HTTP cache headers of the last response that was fully forwarded, used for conditional GETs
+        self.last_etag = None
+        self.last_modified = None
+        self.last_content_length = None
+        # Whether to HEAD-probe before fetching: None until the relay shows it ignores If-Modified-Since,
+        # then True, or False for good once it honours conditional GETs or can't answer the probe
+        self.head_probe = None
+        self.stopping = False  # Set by SIGTERM to end the polling loop
+        
+        # Reuse one session so keep-alive connections to all relays are pooled across polls.
+        # Posts to several targets share it from worker threads; that is safe here because each
+        # request is independent, no auth state changes after construction and the cookie jar
+        # updated from responses is lock-protected
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            # One host pool per target plus the source so no relay's connection gets evicted
+            pool_connections=len(self.target_urls) + 1,
+            pool_maxsize=10,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "User-Agent": "registration-updater"
+        })
         
-        logger.info(f"Initialized tracker: source={self.source_relay}, target={self.target_relay}, interval={self.interval}s")
+        # HEAD probes get their own session without retries so the probe costs at most one round trip
+        self.probe_session = requests.Session()
+        probe_adapter = HTTPAdapter(max_retries=Retry(total=0))
+        self.probe_session.mount("http://", probe_adapter)
+        self.probe_session.mount("https://", probe_adapter)
+        self.probe_session.headers.update(self.session.headers)
+        
+        logger.info(f"Initialized tracker: source={self.source_relay}, targets={', '.join(self.target_urls)}, interval={self.interval}s")
     
     def fetch_validators(self):
         """Fetch validator registrations from Flashbots relay"""
         try:
+            if self.probe_unchanged():
+                logger.info("No changes detected (HEAD probe)")
+                return None
+            
             logger.info(f"Fetching validators from {self.source_relay}")
             
-            response = requests.get(
+            # Let the relay answer 304 when nothing changed since the last forwarded response
+            headers = {}
+            if self.last_etag:
+                headers["If-None-Match"] = self.last_etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+            
+            response = self.session.get(
                 self.source_relay,
-                headers={"Accept": "application/json"}
+                headers=headers,
+                timeout=(3, 10)
             )
             
-            if response.status_code == 200:
-                data = response.json()
+            if response.status_code == 304:
+                if self.head_probe is None:
+                    self.head_probe = False
+                logger.info("No changes detected (not modified)")
+                return None
+            elif response.status_code == 200:
+                # An unchanged Last-Modified on a 200 means the relay ignored If-Modified-Since
+                if (
+                    self.head_probe is None
+                    and "If-Modified-Since" in headers
+                    and response.headers.get("Last-Modified") == headers["If-Modified-Since"]
+                ):
+                    self.head_probe = True
+                    logger.info("Source relay ignores If-Modified-Since, probing with HEAD before fetching")
+                
+                data = orjson.loads(response.content)
                 logger.info(f"Successfully fetched {len(data)} validators")
                 
-                # Check for changes
-                if self.validators is not None:
-                    changes = self.detect_changes(self.validators, data)
-                    if changes["added"] or changes["removed"] or changes["updated"]:
-                        logger.info(f"Changes detected: {len(changes['added'])} added, {len(changes['removed'])} removed, {len(changes['updated'])} updated")
-                        post_success = self.post_to_target(data)
-                        
-                        # Only update stored validators if posting was successful
-                        if post_success:
-                            self.validators = data
-                            logger.info("Updated stored validators after successful post")
-                        else:
-                            logger.warning("Not caching validator changes due to failed post")
-                    else:
-                        logger.info("No changes detected")
-                else:
-                    # First run, post everything
-                    logger.info("First fetch, posting all validators")
-                    post_success = self.post_to_target(data)
+                validators_by_pubkey, digests = self.index_validators(data)
+                
+                # Check for changes, against an empty baseline on the first run so everything is added
+                changes = self.detect_changes(self.digests, digests)
+                if any(changes["counts"]):
+                    added, removed, updated = changes["counts"]
+                    logger.info(f"Changes detected: {added} added, {removed} removed, {updated} updated")
+                    post_success = self.post_to_target(validators_by_pubkey, changes)
                     
                     # Only update stored validators if posting was successful
                     if post_success:
-                        self.validators = data
+                        self.digests = digests
+                        self.remember_cache_headers(response)
                         logger.info("Updated stored validators after successful post")
                     else:
-                        logger.warning("Not storing initial validators due to failed post")
+                        self.transformed_by_pubkey = None
+                        logger.warning("Not caching validator changes due to failed post")
+                else:
+                    self.remember_cache_headers(response)
+                    logger.info("No changes detected")
                 
                 return data
             else:
@@ -77,124 +157,264 @@ class FlashbotsValidatorTracker:
             logger.error(f"Error fetching validators: {str(e)}")
             return None
     
+    def remember_cache_headers(self, response):
+        """Store the response's cache headers once its contents have been forwarded"""
+        self.last_etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+        self.last_content_length = response.headers.get("Content-Length")
+    
+    def probe_unchanged(self):
+        """Check with a HEAD request whether a relay ignoring conditional GETs still serves the last forwarded response"""
+        if not self.head_probe or self.last_etag:
+            return False
+        # Content-Length alone can't tell apart same-sized registrations, and without it
+        # Last-Modified alone is too coarse, so require both
+        if not self.last_modified or self.last_content_length is None:
+            return False
+        
+        try:
+            response = self.probe_session.head(self.source_relay, timeout=3)
+        except requests.RequestException as e:
+            logger.debug(f"HEAD probe failed, falling back to a full fetch: {str(e)}")
+            return False
+        
+        # A relay that rejects HEAD or omits these headers would cost a wasted round trip every poll
+        if (
+            response.status_code != 200
+            or response.headers.get("Last-Modified") is None
+            or response.headers.get("Content-Length") is None
+        ):
+            self.head_probe = False
+            logger.info("Source relay can't answer HEAD probes, disabling them")
+            return False
+        
+        return (
+            response.headers.get("Last-Modified") == self.last_modified
+            and response.headers.get("Content-Length") == self.last_content_length
+        )
+    
     def transform_data_format(self, data):
         """Transform data to match the target API's expected format"""
-        try:
-            # Log a sample of the original data for debugging
-            if data and len(data) > 0:
-                logger.info(f"Original data sample structure: {json.dumps(data[0], indent=2)[:200]}...")
-                
-            # Transform from the GET format to the POST format
-            # GET format: [{"slot": "1", "validator_index": "1", "entry": {"message": {...}, "signature": "..."}}]
-            # POST format: [{"message": {...}, "signature": "..."}]
-            transformed_data = []
+        # Log a sample of the original data for debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            sample = next(iter(data), None)
+            if sample is not None:
+                logger.debug(f"Original data sample structure: {orjson.dumps(sample).decode()[:200]}...")
             
-            for item in data:
-                if "entry" in item and "message" in item["entry"] and "signature" in item["entry"]:
-                    # Extract the message and signature from the entry
-                    transformed_item = {
-                        "message": item["entry"]["message"],
-                        "signature": item["entry"]["signature"]
-                    }
-                    transformed_data.append(transformed_item)
-                else:
-                    logger.warning(f"Item doesn't match expected structure: {json.dumps(item)[:100]}...")
+        # Transform from the GET format to the POST format
+        # GET format: [{"slot": "1", "validator_index": "1", "entry": {"message": {...}, "signature": "..."}}]
+        # POST format: [{"message": {...}, "signature": "..."}]
+        # Items were already shape-checked by index_validators
+        transformed_data = [self._transform_item(item) for item in data]
+        
+        logger.info(f"Transformed {len(data)} records into {len(transformed_data)} records for target API")
+        if logger.isEnabledFor(logging.DEBUG):
+            sample = next(iter(transformed_data), None)
+            if sample is not None:
+                logger.debug(f"Transformed data sample: {orjson.dumps(sample).decode()[:200]}...")
             
-            logger.info(f"Transformed {len(data)} records into {len(transformed_data)} records for target API")
-            if transformed_data and len(transformed_data) > 0:
-                logger.info(f"Transformed data sample: {json.dumps(transformed_data[0], indent=2)[:200]}...")
-                
-            return transformed_data
+        return transformed_data
+    
+    def _transform_item(self, item):
+        """Extract the message and signature from an entry without validating its shape"""
+        entry = item["entry"]
+        return {"message": entry["message"], "signature": entry["signature"]}
+    
+    def update_transformed(self, validators_by_pubkey, changes):
+        """Patch the cached pubkey -> POST entry map with changed validators, rebuilding it when there is no cache"""
+        if self.transformed_by_pubkey is None:
+            self.transformed_by_pubkey = {
+                item["message"]["pubkey"]: item
+                for item in self.transform_data_format(list(validators_by_pubkey.values()))
+            }
+        else:
+            changed_keys = changes["added"] | changes["updated"]
+            patch = {
+                item["message"]["pubkey"]: item
+                for item in self.transform_data_format([validators_by_pubkey[pubkey] for pubkey in changed_keys])
+            }
+            # Never keep posting a stale entry for a changed pubkey the transform didn't return
+            for pubkey in (changed_keys - patch.keys()) | changes["removed"]:
+                self.transformed_by_pubkey.pop(pubkey, None)
+            self.transformed_by_pubkey.update(patch)
+        
+        return self.transformed_by_pubkey
+    
+    def post_to_target(self, validators_by_pubkey, changes):
+        """Post validator data to all target relays, returns True only if every post succeeded"""
+        # Transform data to match the target API's expected format, reusing the cached payload.
+        # A failure counts as a failed post so the caller drops the cache and retries next poll
+        try:
+            transformed_by_pubkey = self.update_transformed(validators_by_pubkey, changes)
         except Exception as e:
             logger.error(f"Error transforming data: {str(e)}")
-            # Return the original data if transformation fails
-            return data
+            return False
+        
+        # Targets that upsert registrations only need the added and updated entries
+        if self.incremental_post:
+            transformed_data = [
+                transformed_by_pubkey[pubkey]
+                for pubkey in changes["added"] | changes["updated"]
+                if pubkey in transformed_by_pubkey
+            ]
+            if not transformed_data:
+                logger.info("Only removals detected, nothing to post incrementally")
+                return True
+        else:
+            transformed_data = list(transformed_by_pubkey.values())
+        
+        # Print a snippet of the payload for debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            sample = next(iter(transformed_data), None)
+            if sample is not None:
+                logger.debug(f"Payload sample: {orjson.dumps(sample).decode()[:200]}...")
+        
+        # Serialize once and share the body between all targets
+        payload = orjson.dumps(transformed_data)
+        count = len(transformed_data)
+        
+        if len(self.target_urls) == 1:
+            return self._post_one(self.target_urls[0], payload, count)
+        
+        # Fan out to multiple targets concurrently so their round trips overlap
+        with ThreadPoolExecutor(max_workers=len(self.target_urls)) as executor:
+            results = list(executor.map(
+                lambda target: self._post_one(target, payload, count),
+                self.target_urls
+            ))
+        return all(results)
     
-    def post_to_target(self, data):
-        """Post validator data to target relay"""
+    def _post_one(self, target_url, payload, count):
+        """Post an encoded validator payload to a single target relay"""
         try:
-            # Transform data to match the target API's expected format
-            transformed_data = self.transform_data_format(data)
-            
-            logger.info(f"Posting {len(transformed_data)} validators to {self.target_relay}")
+            logger.info(f"Posting {count} validators to {target_url}")
             
-            # Print a snippet of the payload for debugging
-            if transformed_data and len(transformed_data) > 0:
-                payload_snippet = json.dumps(transformed_data[0], indent=2)[:200]
-                logger.info(f"Payload sample: {payload_snippet}...")
-            
-            response = requests.post(
-                f"{self.target_relay}/eth/v1/builder/validators",
-                json=transformed_data,
-                headers={"Content-Type": "application/json"}
+            response = self.session.post(
+                target_url,
+                data=payload,
+                headers={"Content-Type": "application/json"},
+                timeout=(3, 10)
             )
             
             if response.status_code in [200, 201, 202]:
-                logger.info(f"Successfully posted data: {response.status_code}")
+                logger.info(f"Successfully posted data to {target_url}: {response.status_code}")
                 return True
             else:
-                logger.error(f"Failed to post data: {response.status_code} {response.reason}")
+                logger.error(f"Failed to post data to {target_url}: {response.status_code} {response.reason}")
                 logger.error(f"Response: {response.text[:200]}...")
                 # Log the full error response for debugging
                 try:
-                    error_detail = response.json()
-                    logger.error(f"Error details: {json.dumps(error_detail, indent=2)}")
-                except:
+                    error_detail = orjson.loads(response.content)
+                    logger.error(f"Error details: {orjson.dumps(error_detail, option=orjson.OPT_INDENT_2).decode()}")
+                except ValueError:
                     pass
                 return False
                 
         except Exception as e:
-            logger.error(f"Error posting to target relay: {str(e)}")
+            logger.error(f"Error posting to target relay {target_url}: {str(e)}")
             return False
     
-    def detect_changes(self, old_data, new_data):
-        """Detect changes between validator sets"""
-        # Extract pubkeys for comparison
-        old_keys = {item["entry"]["message"]["pubkey"]: item for item in old_data}
-        new_keys = {item["entry"]["message"]["pubkey"]: item for item in new_data}
+    def index_validators(self, data):
+        """Index registrations by pubkey and digest their canonical form in a single pass, skipping malformed items"""
+        validators_by_pubkey = {}
+        digests = {}
+        
+        for item in data:
+            try:
+                entry = item["entry"]
+                pubkey = entry["message"]["pubkey"]
+                well_formed = isinstance(pubkey, str) and "signature" in entry
+            except (KeyError, TypeError):
+                well_formed = False
+            
+            if not well_formed:
+                # Decode before truncating so a multi-byte character is never split
+                logger.warning(f"Item doesn't match expected structure: {orjson.dumps(item).decode()[:100]}...")
+                continue
+            
+            validators_by_pubkey[pubkey] = item
+            # Sort keys so a relay reordering fields is not mistaken for an update. Digests never leave
+            # this process, so the builtin 64-bit hash is enough and avoids a hashlib object per entry
+            digests[pubkey] = hash(orjson.dumps(item, option=orjson.OPT_SORT_KEYS))
         
+        return validators_by_pubkey, digests
+    
+    def detect_changes(self, old_digests, new_digests):
+        """Detect changes between validator sets, returns the affected pubkey sets and their counts"""
         # Find differences
-        added_keys = set(new_keys) - set(old_keys)
-        removed_keys = set(old_keys) - set(new_keys)
-        common_keys = set(old_keys) & set(new_keys)
+        added_keys = new_digests.keys() - old_digests.keys()
+        removed_keys = old_digests.keys() - new_digests.keys()
+        common_keys = old_digests.keys() & new_digests.keys()
         
-        # Check for updates
-        updated = []
-        for key in common_keys:
-            if json.dumps(old_keys[key], sort_keys=True) != json.dumps(new_keys[key], sort_keys=True):
-                updated.append(key)
+        # Check for updates, a differing digest means the registration changed
+        updated = {key for key in common_keys if old_digests[key] != new_digests[key]}
         
         return {
-            "added": [new_keys[k] for k in added_keys],
-            "removed": [old_keys[k] for k in removed_keys],
-            "updated": [new_keys[k] for k in updated]
+            "added": added_keys,
+            "removed": removed_keys,
+            "updated": updated,
+            "counts": (len(added_keys), len(removed_keys), len(updated))
         }
     
+    def close(self):
+        """Release pooled connections"""
+        self.session.close()
+        self.probe_session.close()
+    
+    def _handle_sigterm(self, signum, frame):
+        """Ask the polling loop to stop once the current poll finishes"""
+        # Only set a plain flag, threading primitives aren't safe to touch from a signal handler
+        self.stopping = True
+    
+    def _sleep_until(self, deadline):
+        """Sleep until the deadline in short slices so a stop request is noticed promptly"""
+        while not self.stopping:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.5))
+    
     def run(self):
         """Main loop to fetch and forward validator data"""
         logger.info(f"Starting validator tracking (interval: {self.interval}s)")
         
+        # Stop cleanly on SIGTERM (e.g. docker stop) without interrupting a poll mid-request
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        
         try:
-            while True:
+            # Schedule each poll relative to the previous poll's start so fetch time doesn't stretch the period
+            next_tick = time.monotonic()
+            while not self.stopping:
                 self.fetch_validators()
-                time.sleep(self.interval)
+                next_tick += self.interval
+                delay = next_tick - time.monotonic()
+                if delay < 0:
+                    logger.warning(f"Poll overran by {-delay:.2f}s")
+                    next_tick = time.monotonic()
+                self._sleep_until(next_tick)
+            logger.info("Stopped by SIGTERM")
         except KeyboardInterrupt:
             logger.info("Stopped by user")
         except Exception as e:
             logger.error(f"Unexpected error: {str(e)}")
             sys.exit(1)
+        finally:
+            self.close()
 
 def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description="Track and forward Flashbots validator registrations")
     
-    parser.add_argument("--target-relay", "-t", required=True, 
-                        help="URL of target relay to forward validator data")
+    parser.add_argument("--target-relay", "-t", required=True, action="append",
+                        dest="target_relays",
+                        help="URL of target relay to forward validator data (repeat to post to several relays)")
     parser.add_argument("--source-relay", "-s", 
                         default="https://0xafa4c6985aa049fb79dd37010438cfebeb0f2bd42b115b89dd678dab0670c1de38da0c4e9138c9290a398ecd9a0b3110@boost-relay.flashbots.net",
                         help="URL of Flashbots relay (default: %(default)s)")
     parser.add_argument("--interval", "-i", type=int, default=6,  # 6 seconds
                         help="Polling interval in seconds (default: %(default)s)")
+    parser.add_argument("--incremental-post", action="store_true",
+                        help="After the first run, post only added and updated validators instead of the full set")
     parser.add_argument("--debug", "-d", action="store_true",
                         help="Enable detailed debug logging")
     
@@ -208,8 +428,9 @@ def main():
     # Create and run tracker
     config = {
         "source_relay": args.source_relay,
-        "target_relay": args.target_relay,
-        "interval": args.interval
+        "target_relays": args.target_relays,
+        "interval": args.interval,
+        "incremental_post": args.incremental_post
     }
     
     tracker = FlashbotsValidatorTracker(config)